@@ -1,221 +1,130 @@
 import os
-import json
-import difflib
+import time
 import streamlit as st
-import requests
+from utils import (
+    build_prompt,
+    fast_lower,
+    find_known_terms,
+    get_cached_response,
+    get_product_recommendations,
+    hf_stream_chat,
+    possible_gluten_flags_with_links,
+    split_recipes,
+    store_response,
+    warm_model,
+)
 
 
 # Configuration
 HF_TOKEN = os.getenv("HF_API_KEY")
 MODEL_REPO = os.getenv("HF_MODEL_REPO") or "HuggingFaceH4/zephyr-7b-beta:featherless-ai"
-API_URL = "https://router.huggingface.co/v1/chat/completions"
 
 if not HF_TOKEN:
     st.error("Missing Hugging Face API key. Set HF_TOKEN as an environment variable.")
     st.stop()
 
-HEADERS = {"Authorization": f"Bearer {HF_TOKEN}"}
-
-# Load product links
-try:
-    with open("product_links.json", "r", encoding="utf-8") as f:
-        PRODUCT_LINKS = json.load(f)
-except FileNotFoundError:
-    PRODUCT_LINKS = {}
-
-# Gluten substitutions
-SUBS = {
-    "wheat flour": "gluten-free all-purpose flour or rice flour",
-    "flour": "gluten-free all-purpose flour",
-    "breadcrumbs": "gluten-free breadcrumbs or crushed cornflakes",
-    "soy sauce": "tamari (gluten-free) or coconut aminos",
-    "pasta": "gluten-free pasta (rice/corn/quinoa)",
-    "noodles": "rice noodles or glass noodles",
-    "tortilla": "corn tortilla (check GF certified)",
-    "barley": "brown rice or quinoa",
-    "rye": "buckwheat groats (naturally GF)",
-    "couscous": "quinoa or millet",
-    "bulgur": "quinoa or cauliflower rice",
-    "semolina": "rice flour or cornmeal",
-    "malt": "omit or use maple syrup (for flavoring)",
-    "beer": "gluten-free beer or stock"
-}
-
-
-def get_product_link(product_name: str, region: str = "uk"):
-    """
-    Retrieve the product link for a given product and region.
-
-    Args:
-        product_name (str): The name of the product to look up.
-        region (str, optional): The market region code (default is "uk").
-
-    Returns:
-        str or None: The product link if available, otherwise None.
-    """
-    product = product_name.lower()
-    if product in PRODUCT_LINKS and region in PRODUCT_LINKS[product]:
-        base_url = PRODUCT_LINKS[product][region]
-        tag = st.secrets.get(f"product_tag_{region}", "")
-        return f"{base_url}?tag={tag}" if tag else base_url
-    return None
-
-
-def possible_gluten_flags_with_links(ingredients_text: str, region: str = "uk"):
-    """
-    Identify gluten-containing ingredients in the input text and suggest gluten-free substitutes,
-    including product links where available. Skips warnings if the ingredient is already labeled as gluten-free.
-    Uses fuzzy matching to detect misspelled ingredients.
-    
-    Args:
-        ingredients_text (str): The list of ingredients as a string.
-        region (str, optional): The market region code (default is "uk").
-    
-    Returns:
-        list: A list of dictionaries with keys 'ingredient', 'substitute', and 'link'.
-    """
-    import difflib
-
-    text = ingredients_text.lower()
-    words = text.split()
-    flagged = []
-
-    for k, v in SUBS.items():
-        # Direct match check
-        if k in text:
-            if f"gluten-free {k}" in text or f"gf {k}" in text:
-                continue
-            link = get_product_link(v, region)
-            flagged.append({
-                "ingredient": k,
-                "substitute": v,
-                "link": link
-            })
-            continue
-
-        # Handle typos
-        for word in words:
-            close = difflib.get_close_matches(word, k.split(), cutoff=0.8)
-            if close:
-                if f"gluten-free {word}" in text or f"gf {word}" in text:
-                    continue
-                link = get_product_link(v, region)
-                flagged.append({
-                    "ingredient": k,
-                    "substitute": v,
-                    "link": link
-                })
-                break
-
-    return flagged
-
-
-
-def get_product_recommendations(ingredients_text: str, region: str = "uk"):
-    """
-    Suggest relevant gluten-free products based on detected ingredients.
-    Uses fuzzy matching to catch variations (e.g., 'spaguetti' → 'spaghetti').
-
-    Args:
-        ingredients_text (str): The list of ingredients as a string.
-        region (str, optional): The market region code (default is "uk").
-
-    Returns:
-        list: A list of tuples (product, product_link) for recommended products.
-    """
-    recs = []
-    text = ingredients_text.lower().split()
-
-    for product, links in PRODUCT_LINKS.items():
-        link = links.get(region)
-        if not link:
-            continue
-
-        product_words = product.lower().split()
-
-        # Exact phrase match first
-        if all(word in " ".join(text) for word in product_words):
-            recs.append((product, link))
-            continue
-
-        # Fuzzy match (handles typos & variations)
-        for word in text:
-            close = difflib.get_close_matches(word, product_words, cutoff=0.75)
-            if close:
-                recs.append((product, link))
-                break
-
-    return recs
+# Minimum seconds between re-renders of a streaming response
+STREAM_RENDER_INTERVAL = 0.05
 
 
-def hf_generate_chat(prompt_text: str):
+def stream_to_placeholder(stream, placeholder):
     """
-    Sends a prompt to the Hugging Face chat completion API and returns the generated response.
+    Render a streaming response into a placeholder, throttled to STREAM_RENDER_INTERVAL.
 
     Args:
-        prompt_text (str): The prompt or user message to send to the model.
+        stream (iterable): Pieces of generated text, in order.
+        placeholder: A Streamlit `st.empty()` element to render into.
 
     Returns:
-        str: The generated message content from the model.
-
-    Raises:
-        RuntimeError: If the API response status is not 200 (success).
+        str: The full generated text.
     """
-    messages = [{"role": "user", "content": prompt_text}]
-    payload = {"model": MODEL_REPO, "messages": messages}
-    resp = requests.post(API_URL, headers=HEADERS, json=payload, timeout=60)
-    if resp.status_code != 200:
-        raise RuntimeError(f"HF API error {resp.status_code}: {resp.text[:500]}")
-    data = resp.json()
-    return data["choices"][0]["message"]["content"]
-
-
-def build_prompt(ingredients: str, avoid: str, servings: int, recipes_count: int):
+    chunks = []
+    last_render = 0.0
+    for chunk in stream:
+        chunks.append(chunk)
+        now = time.monotonic()
+        if now - last_render >= STREAM_RENDER_INTERVAL:
+            placeholder.markdown("".join(chunks))
+            last_render = now
+    return "".join(chunks)
+
+
+@st.fragment
+def generate_panel(ingredients: str, avoid: str, servings: int, recipes_count: int, region: str, skip_cache: bool):
     """
-    Constructs a prompt for the LLM to generate gluten-free recipes.
+    Render the generate button together with the flags, recipe and product recommendations.
+    Runs as a fragment, so clicking the button reruns only this panel rather than the whole script.
 
     Args:
         ingredients (str): Ingredients provided by the user.
         avoid (str): Allergens or diets to avoid.
         servings (int): Number of servings required.
         recipes_count (int): Number of recipe options to generate.
-
-    Returns:
-        str: A formatted prompt string for the model.
+        region (str): The market region code.
+        skip_cache (bool): Whether to bypass the cached response for an identical prompt.
     """
-    return f"""
-You are a culinary assistant specialized in gluten-free cooking. Ensure every recipe is 100% gluten-free. 
-If any provided ingredient contains gluten, automatically swap it for safe alternatives and mention the swap.
+    if not st.button("Generate recipe(s)"):
+        return
 
-User ingredients: {ingredients}
-Allergens/diet to avoid (besides gluten): {avoid if avoid.strip() else "None specified"}
-Servings: {servings}
-
-TASK: Create {recipes_count} distinct gluten-free recipe OPTIONS that primarily use the user's ingredients.
-Each option must follow EXACTLY this Markdown format:
+    if not ingredients.strip():
+        st.warning("Please enter some ingredients first.")
+        return
 
-# Recipe Title
-Servings: <number>
-Prep: <minutes> | Cook: <minutes>
+    text_lower = fast_lower(ingredients)
+    found = find_known_terms(text_lower)
 
-## Ingredients
-- <bullet list of GF ingredients only>
+    # Show substitutions with product links
+    flags = possible_gluten_flags_with_links(text_lower, found, region)
+    if flags:
+        st.info("Heads up! We detected potential gluten-containing items and suggested swaps:")
+        st.markdown("\n".join(
+            f"- **{f['ingredient']}** → {f['substitute']}" + (f" ([try here]({f['link']}))" if f['link'] else "")
+            for f in flags
+        ))
 
-## Method
-1. <step>
-2. <step>
-3. <step>
+    # Reserve the recipe slot so the locally computed recommendations below can be
+    # shown while the model request is still in flight
+    recipe_slot = st.container()
 
-## Substitutions & Notes
-- <list any swaps or GF cautions>
-- <tips for variations or storage>
+    # Show general product recommendations
+    recs = get_product_recommendations(text_lower, found, region)
+    if recs:
+        st.subheader("🛒 Recommended Gluten-Free Products")
+        st.markdown("\n".join(f"- [{product.title()}]({link})" for product, link in recs))
 
-Keep it concise but practical. Avoid brand names. Always ensure substitutes are safe for celiac/gluten intolerance.
-"""
+    # Generate recipe from HF (or reuse an identical earlier one), rendering it as it streams in
+    with recipe_slot:
+        prompt = build_prompt(ingredients, avoid, servings, recipes_count)
+        placeholder = st.empty()
+        complete = True
+        try:
+            output = None if skip_cache else get_cached_response(prompt, MODEL_REPO)
+            if output is None:
+                with st.spinner("Cooking up ideas..."):
+                    stream = hf_stream_chat(prompt, HF_TOKEN, MODEL_REPO)
+                output = stream_to_placeholder(stream, placeholder)
+                # Only cache responses the server marked complete
+                complete = stream.done
+                if complete:
+                    store_response(prompt, MODEL_REPO, output)
+        except Exception as e:
+            placeholder.empty()
+            st.error(f"Generation error: {e}")
+        else:
+            with placeholder.container():
+                for i, recipe in enumerate(split_recipes(output)):
+                    if i:
+                        st.divider()
+                    st.markdown(recipe)
+            if complete:
+                st.caption(f"Model: {MODEL_REPO}")
+            else:
+                st.warning("The response was cut off before completion; try regenerating.")
 
 
 # Streamlit UI
 st.set_page_config(page_title="SinGlu", page_icon="🍲", layout="centered")
+warm_model(HF_TOKEN, MODEL_REPO)
 st.title("🍲 SinGlu - Gluten-Free Recipe Generator")
 st.write("Enter your ingredients and get **gluten-free** recipes with substitutions and recommended products.")
 
@@ -223,6 +132,7 @@ with st.expander("Advanced options"):
     recipes_count = st.slider("How many recipe options?", min_value=1, max_value=3, value=2)
     servings = st.slider("Servings", min_value=1, max_value=8, value=2)
     region = st.selectbox("Market region", options=["uk", "es"], index=0)
+    skip_cache = st.checkbox("Regenerate (skip cache)")
 
 ingredients = st.text_area(
     "Ingredients you have (comma or line separated)",
@@ -231,37 +141,6 @@ ingredients = st.text_area(
 )
 avoid = st.text_input("Avoid (optional, e.g., dairy, nuts)")
 
-if st.button("Generate recipe(s)"):
-    if not ingredients.strip():
-        st.warning("Please enter some ingredients first.")
-        st.stop()
-
-    # Show substitutions with product links
-    flags = possible_gluten_flags_with_links(ingredients, region)
-    if flags:
-        st.info("Heads up! We detected potential gluten-containing items and suggested swaps:")
-        for f in flags:
-            sub_text = f"**{f['ingredient']}** → {f['substitute']}"
-            if f['link']:
-                sub_text += f" ([try here]({f['link']}))"
-            st.markdown(f"- {sub_text}")
-
-    # Generate recipe from HF
-    with st.spinner("Cooking up ideas..."):
-        prompt = build_prompt(ingredients, avoid, servings, recipes_count)
-        try:
-            output = hf_generate_chat(prompt)
-        except Exception as e:
-            st.error(f"Generation error: {e}")
-        else:
-            st.markdown(output)
-            st.caption(f"Model: {MODEL_REPO}")
-
-    # Show general product recommendations
-    recs = get_product_recommendations(ingredients, region)
-    if recs:
-        st.subheader("🛒 Recommended Gluten-Free Products")
-        for product, link in recs:
-            st.markdown(f"- [{product.title()}]({link})")
+generate_panel(ingredients, avoid, servings, recipes_count, region, skip_cache)
 
 st.caption("⚠️ Set your Hugging Face API key as an environment variable: HF_TOKEN=...")
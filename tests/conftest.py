@@ -0,0 +1,7 @@
+import os
+import sys
+
+# utils.py lives at the repo root and loads product_links.json by relative path
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
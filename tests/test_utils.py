@@ -0,0 +1,207 @@
+import pytest
+
+import utils
+
+from utils import (
+    ChatStream,
+    build_batched_prompt,
+    build_fuzzy_matcher,
+    build_prompt,
+    build_term_automaton,
+    fast_lower,
+    find_known_terms,
+    get_cached_response,
+    get_product_recommendations,
+    get_response_cache,
+    possible_gluten_flags_with_links,
+    split_recipes,
+    store_response,
+)
+
+ALL_PRODUCTS = [
+    "gluten-free spaghetti pasta",
+    "gluten-free penne pasta",
+    "gluten-free pasta star soup",
+    "gluten-free sourdough loaf bread",
+]
+
+# Expected results were recorded from the original per-key / per-word scanning loops
+CASES = [
+    # Overlapping keys are all flagged
+    ("2 cups wheat flour, soy sauce, chicken", ["wheat flour", "flour", "soy sauce"], []),
+    # Labels only cover the exact key they precede
+    ("gluten-free wheat flour and gf soy sauce", ["flour"], ALL_PRODUCTS),
+    ("gf pasta, gluten-free breadcrumbs, barley", ["barley"], ALL_PRODUCTS),
+    ("gluten-free penne pasta", ["pasta"], ALL_PRODUCTS),
+    # Typos
+    ("chiken, brreadcrumbs, spagetti", ["breadcrumbs"], ["gluten-free spaghetti pasta"]),
+    ("gf brreadcrumbs, tomatoes", [], []),
+    ("Sourdough Bread", [], ["gluten-free sourdough loaf bread"]),
+    ("rice, chicken, spinach", [], []),
+]
+
+
+def scan(ingredients, region="uk"):
+    text_lower = fast_lower(ingredients)
+    found = find_known_terms(text_lower)
+    flags = possible_gluten_flags_with_links(text_lower, found, region)
+    recs = get_product_recommendations(text_lower, found, region)
+    return [f["ingredient"] for f in flags], [product for product, _ in recs]
+
+
+@pytest.mark.parametrize("ingredients, expected_flags, expected_recs", CASES)
+def test_scan_matches_original_results(ingredients, expected_flags, expected_recs):
+    flags, recs = scan(ingredients)
+    assert flags == expected_flags
+    assert recs == expected_recs
+
+
+def test_recommendations_use_region_links():
+    text_lower = fast_lower("spagetti")
+    recs = get_product_recommendations(text_lower, find_known_terms(text_lower), "es")
+    assert recs == [("gluten-free spaghetti pasta", "https://www.amazon.es/dp/B01IUL76SE")]
+
+
+def test_matchers_are_built_once():
+    assert build_term_automaton() is build_term_automaton()
+    assert build_fuzzy_matcher() is build_fuzzy_matcher()
+
+
+class FakeResponse:
+    """Stand-in for a streaming requests.Response with fixed SSE lines."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.closed = True
+
+    def iter_lines(self):
+        return iter(self.lines)
+
+
+def test_chat_stream_yields_content_until_done():
+    resp = FakeResponse([
+        b'data: {"choices":[{"delta":{"role":"assistant"}}]}',
+        b"",
+        b": keep-alive",
+        b'data: {"choices":[]}',
+        b'data: {"choices":[{"delta":{"content":"# R1"}}]}',
+        b'data: {"choices":[{"delta":{"content":""}}]}',
+        b'data: {"choices":[{"delta":{"content":"\\nStep"}}]}',
+        b"data: [DONE]",
+        b'data: {"choices":[{"delta":{"content":"ignored"}}]}',
+    ])
+    stream = ChatStream(resp)
+    assert list(stream) == ["# R1", "\nStep"]
+    assert stream.done
+    assert resp.closed
+
+
+def test_chat_stream_without_done_is_incomplete():
+    stream = ChatStream(FakeResponse([b'data: {"choices":[{"delta":{"content":"half a recip"}}]}']))
+    assert list(stream) == ["half a recip"]
+    assert not stream.done
+
+
+@pytest.mark.parametrize("frame, message", [
+    (b'data: {"error":{"message":"Model overloaded"}}', "HF API stream error: Model overloaded"),
+    (b'data: {"error":"Input validation error"}', "HF API stream error: Input validation error"),
+])
+def test_chat_stream_raises_on_error_frame(frame, message):
+    stream = ChatStream(FakeResponse([b'data: {"choices":[{"delta":{"content":"# R1"}}]}', frame, b"data: [DONE]"]))
+    with pytest.raises(RuntimeError) as excinfo:
+        list(stream)
+    assert str(excinfo.value) == message
+    assert not stream.done
+
+
+@pytest.fixture
+def response_cache(monkeypatch):
+    """Empty the shared response cache and drive its clock by hand."""
+    clock = [1000.0]
+    monkeypatch.setattr(utils.time, "monotonic", lambda: clock[0])
+    cache = get_response_cache()
+    cache.clear()
+    yield cache, clock
+    cache.clear()
+
+
+def test_response_cache_evicts_oldest_beyond_cap(response_cache, monkeypatch):
+    cache, _ = response_cache
+    monkeypatch.setattr(utils, "RESPONSE_CACHE_MAX_ENTRIES", 3)
+    for i in range(5):
+        store_response(f"prompt {i}", "model", f"recipe {i}")
+    assert [prompt for prompt, _ in cache] == ["prompt 2", "prompt 3", "prompt 4"]
+    assert get_cached_response("prompt 1", "model") is None
+    assert get_cached_response("prompt 4", "model") == "recipe 4"
+
+
+def test_response_cache_restore_updates_and_moves_to_newest(response_cache, monkeypatch):
+    cache, _ = response_cache
+    monkeypatch.setattr(utils, "RESPONSE_CACHE_MAX_ENTRIES", 3)
+    for i in range(3):
+        store_response(f"prompt {i}", "model", f"recipe {i}")
+    store_response("prompt 0", "model", "recipe 0 again")
+    store_response("prompt 3", "model", "recipe 3")
+    assert [prompt for prompt, _ in cache] == ["prompt 2", "prompt 0", "prompt 3"]
+    assert get_cached_response("prompt 0", "model") == "recipe 0 again"
+
+
+def test_response_cache_is_keyed_on_model(response_cache):
+    store_response("prompt", "model-a", "recipe")
+    assert get_cached_response("prompt", "model-a") == "recipe"
+    assert get_cached_response("prompt", "model-b") is None
+
+
+def test_response_cache_expires_after_ttl(response_cache, monkeypatch):
+    cache, clock = response_cache
+    monkeypatch.setattr(utils, "RESPONSE_CACHE_TTL", 10)
+    store_response("old", "model", "old recipe")
+    clock[0] += 9
+    assert get_cached_response("old", "model") == "old recipe"
+    clock[0] += 1
+    assert get_cached_response("old", "model") is None
+    # Expired entries are dropped on the next store
+    store_response("new", "model", "new recipe")
+    assert list(cache) == [("new", "model")]
+
+
+@pytest.mark.parametrize("output", ["", "  \n\t "])
+def test_response_cache_skips_blank_output(response_cache, output):
+    cache, _ = response_cache
+    store_response("prompt", "model", output)
+    assert not cache
+    assert get_cached_response("prompt", "model") is None
+
+
+@pytest.mark.parametrize("output, expected", [
+    ("# A\n===\n# B", ["# A", "# B"]),
+    ("# A\n====\n# B", ["# A", "# B"]),
+    ("# A\n   ===  \n# B", ["# A", "# B"]),
+    ("===\n# A\n===\n\n===\n# B\n===\n", ["# A", "# B"]),
+    ("# A\nMix a === b, then serve\n===\n# B", ["# A\nMix a === b, then serve", "# B"]),
+    ("# A\n==\n# B", ["# A\n==\n# B"]),
+])
+def test_split_recipes_on_whole_separator_lines(output, expected):
+    assert split_recipes(output) == expected
+
+
+def test_batched_prompt_numbers_each_ingredient_set():
+    prompt = build_batched_prompt(["rice, eggs", "pasta, tomato"], "", 2, 1)
+    assert "Ingredient set 1: rice, eggs\nIngredient set 2: pasta, tomato\n" in prompt
+    assert "For EACH ingredient set above, in order, create 1 distinct gluten-free" in prompt
+    assert "Separate consecutive recipes with a line containing only ===." in prompt
+    assert "User ingredients:" not in prompt
+
+
+def test_prompt_keeps_braces_in_user_input():
+    prompt = build_prompt("rice {and} {0} beans}", "nuts {x}", 3, 2)
+    assert "User ingredients: rice {and} {0} beans}\n" in prompt
+    assert "Allergens/diet to avoid (besides gluten): nuts {x}\n" in prompt
+    assert "Servings: 3\n" in prompt
+    assert "Create 2 distinct gluten-free recipe OPTIONS" in prompt
@@ -1,11 +1,583 @@
 # utils.py
+import re
+import json
+import time
+import difflib
+import threading
+import functools
+import streamlit as st
 import requests
+import orjson
+import ahocorasick
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+API_URL = "https://router.huggingface.co/v1/chat/completions"
+
+
+@st.cache_resource
+def get_http_session(api_key: str):
+    """
+    Create a pooled HTTP session for the Hugging Face API, shared across reruns and sessions.
+    Keeps connections alive so each generation skips the TCP/TLS handshake, and retries
+    transient rate-limit, timeout and model-loading responses with jittered exponential
+    backoff, honouring any Retry-After header the API sends.
+
+    Args:
+        api_key (str): Hugging Face API key used for the Authorization header.
+
+    Returns:
+        requests.Session: Session with auth headers and retrying adapter mounted.
+    """
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {api_key}"})
+    retries = Retry(
+        total=6,
+        backoff_factor=1.0,
+        backoff_jitter=0.5,
+        status_forcelist=[408, 429, 503],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
+
+
+@st.cache_data
+def load_product_links(path: str = "product_links.json"):
+    """
+    Load the product links file once and keep the parsed result cached across reruns.
+
+    Args:
+        path (str, optional): Path to the product links JSON file (default is "product_links.json").
+
+    Returns:
+        dict: Mapping of product name to a dict of region code → URL, or an empty dict if the file is missing.
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# Load product links, keyed by lowercased product name
+PRODUCT_LINKS = {product.lower(): links for product, links in load_product_links().items()}
+
+# Gluten substitutions
+SUBS = {
+    "wheat flour": "gluten-free all-purpose flour or rice flour",
+    "flour": "gluten-free all-purpose flour",
+    "breadcrumbs": "gluten-free breadcrumbs or crushed cornflakes",
+    "soy sauce": "tamari (gluten-free) or coconut aminos",
+    "pasta": "gluten-free pasta (rice/corn/quinoa)",
+    "noodles": "rice noodles or glass noodles",
+    "tortilla": "corn tortilla (check GF certified)",
+    "barley": "brown rice or quinoa",
+    "rye": "buckwheat groats (naturally GF)",
+    "couscous": "quinoa or millet",
+    "bulgur": "quinoa or cauliflower rice",
+    "semolina": "rice flour or cornmeal",
+    "malt": "omit or use maple syrup (for flavoring)",
+    "beer": "gluten-free beer or stock"
+}
+
+# Line the model places between recipes when several are generated in one call
+RECIPE_SEPARATOR = "==="
+
+# Matches a whole separator line; models often write more than three "=" characters
+RECIPE_SEPARATOR_RE = re.compile(r"^\s*={3,}\s*$", re.M)
+
+# Seconds a generated response is reused for an identical prompt and model
+RESPONSE_CACHE_TTL = 3600
+
+# Most responses kept at once; the oldest are evicted beyond this
+RESPONSE_CACHE_MAX_ENTRIES = 128
+
+# Guards the shared response cache, which every session's script thread writes to
+RESPONSE_CACHE_LOCK = threading.Lock()
+
+# Recipe generation prompt, filled in by build_batched_prompt()
+PROMPT_TEMPLATE = """\
+You are a culinary assistant specialized in gluten-free cooking. Ensure every recipe is 100% gluten-free.
+If any provided ingredient contains gluten, automatically swap it for safe alternatives and mention the swap.
+
+{ingredients_block}
+Allergens/diet to avoid (besides gluten): {avoid}
+Servings: {servings}
+
+TASK: {task}
+Separate consecutive recipes with a line containing only {separator}.
+Each option must follow EXACTLY this Markdown format:
+
+# Recipe Title
+Servings: <number>
+Prep: <minutes> | Cook: <minutes>
+
+## Ingredients
+- <bullet list of GF ingredients only>
+
+## Method
+1. <step>
+2. <step>
+3. <step>
+
+## Substitutions & Notes
+- <list any swaps or GF cautions>
+- <tips for variations or storage>
+
+Keep it concise but practical. Avoid brand names. Always ensure substitutes are safe for celiac/gluten intolerance.
+"""
+
+
+@st.cache_resource
+def build_term_automaton():
+    """
+    Build one Aho–Corasick automaton over the gluten substitution keys, their
+    gluten-free labelled forms ("gluten-free <key>", "gf <key>") and every product
+    word, so a single pass over the input serves both the gluten flags and the
+    product recommendations. Built once per process.
+
+    Returns:
+        ahocorasick.Automaton: Automaton whose values are the matched terms.
+    """
+    terms = set(SUBS)
+    for k in SUBS:
+        terms.update((f"gluten-free {k}", f"gf {k}"))
+    for product in PRODUCT_LINKS:
+        terms.update(product.split())
+
+    automaton = ahocorasick.Automaton()
+    for term in terms:
+        automaton.add_word(term, term)
+    automaton.make_automaton()
+    return automaton
+
+
+@st.cache_resource
+def build_fuzzy_matcher():
+    """
+    Build a memoized typo matcher over the words of the substitution keys and product names.
+    Each distinct input word is compared against the whole vocabulary once per process,
+    instead of once per key or product on every click.
+
+    Returns:
+        callable: `match(word)` returning a pair of frozensets, the SUBS key words within
+        0.8 similarity and the product words within 0.75 similarity of `word`.
+    """
+    sub_words = sorted({w for k in SUBS for w in k.split()})
+    product_words = sorted({w for product in PRODUCT_LINKS for w in product.split()})
+
+    @functools.lru_cache(maxsize=4096)
+    def match(word: str):
+        return (
+            frozenset(difflib.get_close_matches(word, sub_words, n=max(len(sub_words), 1), cutoff=0.8)),
+            frozenset(difflib.get_close_matches(word, product_words, n=max(len(product_words), 1), cutoff=0.75)),
+        )
+
+    return match
+
+
+def fast_lower(text: str):
+    """
+    Lowercase text for matching. Pure-ASCII input (the common case) takes the plain
+    `str.lower()` path; anything else is case-folded so non-ASCII spellings still match.
+
+    Args:
+        text (str): Text as entered by the user.
+
+    Returns:
+        str: The lowercased (or case-folded) text.
+    """
+    return text.lower() if text.isascii() else text.casefold()
+
+
+def find_known_terms(text_lower: str):
+    """
+    Find every substitution key, labelled key and product word occurring in the text, in one pass.
+
+    Args:
+        text_lower (str): The list of ingredients as an already-lowercased string.
+
+    Returns:
+        set: The terms found anywhere in the text (substring matches, overlaps included).
+    """
+    return {term for _, term in build_term_automaton().iter(text_lower)}
+
+
+@st.cache_resource
+def build_product_index():
+    """
+    Group the product links by region once per process, with each product's words
+    pre-split, so recommendations only walk the products available in the chosen region.
+
+    Returns:
+        dict: Mapping of region code → tuple of (product, product_words, link) entries.
+    """
+    index = {}
+    for product, links in PRODUCT_LINKS.items():
+        product_words = tuple(product.split())
+        for region, link in links.items():
+            if link:
+                index.setdefault(region, []).append((product, product_words, link))
+    return {region: tuple(entries) for region, entries in index.items()}
+
+
+@st.cache_resource
+def build_formatted_links():
+    """
+    Build the final product URL for every (product, region) pair once per process,
+    reading each region's `product_tag_<region>` secret a single time.
+
+    Returns:
+        dict: Mapping of (product, region) → URL, with `?tag=` appended when a tag is configured.
+    """
+    regions = {region for links in PRODUCT_LINKS.values() for region in links}
+    try:
+        tags = {region: st.secrets.get(f"product_tag_{region}", "") for region in regions}
+    except FileNotFoundError:
+        tags = {}
+
+    formatted = {}
+    for product, links in PRODUCT_LINKS.items():
+        for region, base_url in links.items():
+            tag = tags.get(region)
+            formatted[(product, region)] = f"{base_url}?tag={tag}" if tag else base_url
+    return formatted
+
+
+def get_product_link(product_name: str, region: str = "uk"):
+    """
+    Retrieve the product link for a given product and region.
+
+    Args:
+        product_name (str): The name of the product to look up.
+        region (str, optional): The market region code (default is "uk").
+
+    Returns:
+        str or None: The product link if available, otherwise None.
+    """
+    return build_formatted_links().get((product_name.lower(), region))
+
+
+def possible_gluten_flags_with_links(text_lower: str, found: set, region: str = "uk"):
+    """
+    Identify gluten-containing ingredients in the input text and suggest gluten-free substitutes,
+    including product links where available. Skips warnings if the ingredient is already labeled as gluten-free.
+    Uses fuzzy matching to detect misspelled ingredients.
+    
+    Args:
+        text_lower (str): The list of ingredients as an already-lowercased string.
+        found (set): Terms found in the text by find_known_terms().
+        region (str, optional): The market region code (default is "uk").
+    
+    Returns:
+        list: A list of dictionaries with keys 'ingredient', 'substitute', and 'link'.
+    """
+    match = build_fuzzy_matcher()
+    flagged = []
+
+    # Key words that an input word is a likely misspelling of
+    typo_words = set()
+    for word in text_lower.split():
+        close = match(word)[0]
+        if close and not (f"gluten-free {word}" in text_lower or f"gf {word}" in text_lower):
+            typo_words.update(close)
+
+    for k, v in SUBS.items():
+        # Direct match check
+        if k in found:
+            if f"gluten-free {k}" in found or f"gf {k}" in found:
+                continue
+            link = get_product_link(v, region)
+            flagged.append({
+                "ingredient": k,
+                "substitute": v,
+                "link": link
+            })
+            continue
+
+        # Handle typos
+        if typo_words.intersection(k.split()):
+            link = get_product_link(v, region)
+            flagged.append({
+                "ingredient": k,
+                "substitute": v,
+                "link": link
+            })
+
+    return flagged
+
+
+
+def get_product_recommendations(text_lower: str, found: set, region: str = "uk"):
+    """
+    Suggest relevant gluten-free products based on detected ingredients.
+    Uses fuzzy matching to catch variations (e.g., 'spaguetti' → 'spaghetti').
+
+    Args:
+        text_lower (str): The list of ingredients as an already-lowercased string.
+        found (set): Terms found in the text by find_known_terms().
+        region (str, optional): The market region code (default is "uk").
+
+    Returns:
+        list: A list of tuples (product, product_link) for recommended products.
+    """
+    match = build_fuzzy_matcher()
+    recs = []
+
+    # Product words that an input word is a likely misspelling or variation of
+    close_words = set()
+    for word in text_lower.split():
+        close_words.update(match(word)[1])
+
+    for product, product_words, link in build_product_index().get(region, ()):
+        # Exact phrase match first
+        if all(word in found for word in product_words):
+            recs.append((product, link))
+            continue
+
+        # Fuzzy match (handles typos & variations)
+        if close_words.intersection(product_words):
+            recs.append((product, link))
+
+    return recs
+
+
+def hf_stream_chat(prompt_text: str, api_key: str, model_repo: str):
+    """
+    Sends a prompt to the Hugging Face chat completion API with streaming enabled.
+    The request is sent immediately; the response body is consumed lazily as the model generates.
+
+    Args:
+        prompt_text (str): The prompt or user message to send to the model.
+        api_key (str): Hugging Face API key.
+        model_repo (str): The model to send the prompt to.
+
+    Returns:
+        ChatStream: Iterable yielding pieces of the generated message content as they arrive.
+
+    Raises:
+        RuntimeError: If the API response status is not 200 (success).
+    """
+    messages = [{"role": "user", "content": prompt_text}]
+    payload = {"model": model_repo, "messages": messages, "stream": True}
+    resp = get_http_session(api_key).post(
+        API_URL,
+        data=orjson.dumps(payload),
+        headers={"Content-Type": "application/json"},
+        timeout=60,
+        stream=True,
+    )
+    if resp.status_code != 200:
+        error_text = resp.text[:500]
+        resp.close()
+        raise RuntimeError(f"HF API error {resp.status_code}: {error_text}")
+    return ChatStream(resp)
+
+
+@st.cache_resource
+def warm_model(api_key: str, model_repo: str):
+    """
+    Send a throwaway 1-token request once per process so a cold model starts loading
+    while the page renders, rather than on the user's first generation. The request runs
+    on a background thread and any failure is ignored.
+
+    Args:
+        api_key (str): Hugging Face API key.
+        model_repo (str): The model to warm up.
+
+    Returns:
+        threading.Thread: The thread sending the warm-up request.
+    """
+    session = get_http_session(api_key)
+    payload = {"model": model_repo, "messages": [{"role": "user", "content": "hi"}], "max_tokens": 1}
+
+    def ping():
+        try:
+            session.post(
+                API_URL,
+                data=orjson.dumps(payload),
+                headers={"Content-Type": "application/json"},
+                timeout=30,
+            ).close()
+        except requests.RequestException:
+            pass
+
+    thread = threading.Thread(target=ping, daemon=True)
+    thread.start()
+    return thread
+
+
+class ChatStream:
+    """
+    Iterate a chat completion server-sent event stream as content deltas.
+    `done` is set once the `[DONE]` frame arrives, so a stream that ended early can be
+    told apart from a complete one.
+
+    Args:
+        resp (requests.Response): A streaming response from the chat completion API.
+
+    Raises:
+        RuntimeError: If the stream carries an error frame.
+    """
+
+    def __init__(self, resp):
+        self.resp = resp
+        self.done = False
+
+    def __iter__(self):
+        with self.resp:
+            for line in self.resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    self.done = True
+                    break
+                frame = orjson.loads(data)
+                error = frame.get("error")
+                if error:
+                    message = error.get("message", error) if isinstance(error, dict) else error
+                    raise RuntimeError(f"HF API stream error: {message}")
+                choices = frame.get("choices")
+                if not choices:
+                    continue
+                content = choices[0].get("delta", {}).get("content")
+                if content:
+                    yield content
+
+
+@st.cache_resource
+def get_response_cache():
+    """
+    Process-wide store of generated responses, shared across reruns and sessions.
+    Kept as a cache resource rather than wrapping the API call in st.cache_data, so that
+    cache misses can still stream the response into the page while it is generated.
+
+    Returns:
+        dict: Mapping of (prompt_text, model_repo) → (timestamp, response text), oldest first.
+    """
+    return {}
+
+
+def get_cached_response(prompt_text: str, model_repo: str):
+    """
+    Look up a previously generated response for the same prompt and model.
+
+    Args:
+        prompt_text (str): The prompt sent to the model.
+        model_repo (str): The model the prompt was sent to.
+
+    Returns:
+        str or None: The cached response if one is younger than RESPONSE_CACHE_TTL, otherwise None.
+    """
+    entry = get_response_cache().get((prompt_text, model_repo))
+    if entry and entry[1] and time.monotonic() - entry[0] < RESPONSE_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def store_response(prompt_text: str, model_repo: str, output: str):
+    """
+    Cache a generated response, dropping entries older than RESPONSE_CACHE_TTL and
+    evicting the oldest ones beyond RESPONSE_CACHE_MAX_ENTRIES. Empty output is not stored.
+
+    Args:
+        prompt_text (str): The prompt sent to the model.
+        model_repo (str): The model the prompt was sent to.
+        output (str): The full generated response.
+    """
+    if not output.strip():
+        return
+
+    cache = get_response_cache()
+    key = (prompt_text, model_repo)
+    now = time.monotonic()
+    with RESPONSE_CACHE_LOCK:
+        # Re-insert so the dict stays ordered oldest first
+        cache.pop(key, None)
+        for old_key, (created, _) in list(cache.items()):
+            if now - created >= RESPONSE_CACHE_TTL:
+                del cache[old_key]
+        while len(cache) >= RESPONSE_CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]
+        cache[key] = (now, output)
+
+
+def build_prompt(ingredients: str, avoid: str, servings: int, recipes_count: int):
+    """
+    Constructs a prompt for the LLM to generate gluten-free recipes.
+    All recipe options are requested in a single prompt so generation costs one HTTP round trip.
+
+    Args:
+        ingredients (str): Ingredients provided by the user.
+        avoid (str): Allergens or diets to avoid.
+        servings (int): Number of servings required.
+        recipes_count (int): Number of recipe options to generate.
+
+    Returns:
+        str: A formatted prompt string for the model.
+    """
+    return build_batched_prompt([ingredients], avoid, servings, recipes_count)
+
+
+def build_batched_prompt(ingredient_sets: list, avoid: str, servings: int, recipes_count: int):
+    """
+    Constructs a single prompt asking for recipes for one or more ingredient sets.
+    Coalescing every set into one request avoids paying the per-request network and
+    model queueing overhead once per set. Recipes come back separated by RECIPE_SEPARATOR
+    lines so the output can be split with split_recipes().
+
+    Args:
+        ingredient_sets (list): Ingredient strings, one per set.
+        avoid (str): Allergens or diets to avoid.
+        servings (int): Number of servings required.
+        recipes_count (int): Number of recipe options to generate per ingredient set.
+
+    Returns:
+        str: A formatted prompt string for the model.
+    """
+    if len(ingredient_sets) == 1:
+        ingredients_block = f"User ingredients: {ingredient_sets[0]}"
+        task = f"Create {recipes_count} distinct gluten-free recipe OPTIONS that primarily use the user's ingredients."
+    else:
+        ingredients_block = "\n".join(
+            f"Ingredient set {i}: {ingredients}" for i, ingredients in enumerate(ingredient_sets, start=1)
+        )
+        task = (f"For EACH ingredient set above, in order, create {recipes_count} distinct gluten-free "
+                f"recipe OPTIONS that primarily use that set's ingredients.")
+
+    return PROMPT_TEMPLATE.format_map({
+        "ingredients_block": ingredients_block,
+        "avoid": avoid if avoid.strip() else "None specified",
+        "servings": servings,
+        "task": task,
+        "separator": RECIPE_SEPARATOR,
+    })
+
+
+def split_recipes(output: str):
+    """
+    Split a model response into individual recipes on lines containing only "=" characters
+    (at least three, as in RECIPE_SEPARATOR).
+
+    Args:
+        output (str): The generated message content from the model.
+
+    Returns:
+        list: Non-empty recipe Markdown blocks, in the order they were generated.
+    """
+    return [block.strip() for block in RECIPE_SEPARATOR_RE.split(output) if block.strip()]
+
 
 def call_hf_model(prompt: str, api_key: str, model_repo: str):
     """Call Hugging Face text-generation API."""
     url = f"https://api-inference.huggingface.co/models/{model_repo}"
-    headers = {"Authorization": f"Bearer {api_key}"}
+    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
     payload = {"inputs": prompt, "parameters": {"max_new_tokens": 500}}
-    response = requests.post(url, headers=headers, json=payload)
+    response = requests.post(url, headers=headers, data=orjson.dumps(payload))
     response.raise_for_status()
-    return response.json()[0]["generated_text"]
+    return orjson.loads(response.content)[0]["generated_text"]